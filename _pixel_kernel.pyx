@@ -0,0 +1,59 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Cython build of the per-pixel kernel, used by image_processing when Numba is not installed.
+Build it in place with:
+    python setup.py build_ext --inplace
+"""
+from libc.math cimport rint
+
+def build_blocks(const unsigned char[:, :, ::1] rgba, const float[:, ::1] depth_map,
+                 const double[::1] eye_pos, const double[::1] look_vector,
+                 const double[::1] right_vector, const double[::1] true_up_vector,
+                 double output_width, double output_height, double base_distance,
+                 double far_threshold, double pixel_scale,
+                 const unsigned short[::1] lut, const unsigned char[:, ::1] active,
+                 int[:, :, ::1] out_xyz, long long[:, ::1] out_bid, long long[::1] out_count):
+    """
+    Same contract as image_processing._build_blocks_kernel: every row writes into its
+    own slice of out_xyz/out_bid (room for 4 blocks per pixel) and records how many
+    it used in out_count.
+    """
+    cdef Py_ssize_t height = depth_map.shape[0]
+    cdef Py_ssize_t width = depth_map.shape[1]
+    cdef double center_x = width / 2.0
+    cdef double center_y = height / 2.0
+    cdef Py_ssize_t row, col, count, k
+    cdef int corner, n_corners
+    cdef unsigned short block_idx
+    cdef double distance, scale_factor, norm_offset_right, norm_offset_up, step, pos
+
+    with nogil:
+        for row in range(height):
+            count = 0
+            for col in range(width):
+                if not active[row, col]:
+                    continue
+                block_idx = lut[((<unsigned int>rgba[row, col, 0] >> 3) << 10)
+                                | ((<unsigned int>rgba[row, col, 1] >> 3) << 5)
+                                | (<unsigned int>rgba[row, col, 2] >> 3)]
+
+                distance = depth_map[row, col]
+                scale_factor = distance / base_distance
+                norm_offset_right = -((col - center_x) / (width / 2.0)) * (output_width / 2) * scale_factor
+                norm_offset_up = ((center_y - row) / (height / 2.0)) * (output_height / 2) * scale_factor
+                step = pixel_scale * scale_factor
+
+                # Corners 1-3 (right, up, right+up) are only drawn for far pixels.
+                n_corners = 4 if distance >= far_threshold else 1
+                for corner in range(n_corners):
+                    for k in range(3):
+                        pos = (eye_pos[k] + look_vector[k] * distance
+                               + right_vector[k] * norm_offset_right + true_up_vector[k] * norm_offset_up)
+                        if corner & 1:
+                            pos = pos + step * right_vector[k]
+                        if corner & 2:
+                            pos = pos + step * true_up_vector[k]
+                        out_xyz[row, count, k] = <int>rint(pos)
+                    out_bid[row, count] = block_idx
+                    count += 1
+            out_count[row] = count
@@ -1,8 +1,26 @@
 import math
+import os
 import re
 import json
+import functools
 from PIL import Image
 import numpy as np
+from scipy.spatial import cKDTree
+
+try:
+    import numba
+except ImportError:  # Numba is optional; the Cython kernel or the NumPy path is used without it.
+    numba = None
+
+try:
+    from _pixel_kernel import build_blocks as _cython_build_blocks
+except ImportError:  # Optional; built with `python setup.py build_ext --inplace`.
+    _cython_build_blocks = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the standard json module is used without it.
+    orjson = None
 
 ##############################################################################
 #                           HELPER FUNCTIONS
@@ -29,9 +47,9 @@ def dot(u, v):
     return u[0]*v[0] + u[1]*v[1] + u[2]*v[2]
 
 def cross(u, v):
-    return (u[1]*v[2] - u[2]*v[1],
-            u[2]*v[0] - u[0]*v[2],
-            u[0]*v[1] - u[1]*v[0])
+    return np.array([u[1]*v[2] - u[2]*v[1],
+                     u[2]*v[0] - u[0]*v[2],
+                     u[0]*v[1] - u[1]*v[0]], dtype=np.float64)
 
 def norm(u):
     return math.sqrt(dot(u, u))
@@ -39,8 +57,8 @@ def norm(u):
 def normalize(u):
     n = norm(u)
     if n == 0:
-        return (0, 0, 0)
-    return (u[0]/n, u[1]/n, u[2]/n)
+        return np.zeros(3)
+    return np.asarray(u, dtype=np.float64) / n
 
 ##############################################################################
 #                   COLOR MAPPING FUNCTIONS
@@ -49,28 +67,105 @@ def normalize(u):
 def load_rgb_data(rgb_json_path):
     """
     Loads the block-to-RGB mapping from the JSON file.
-    Returns a dict: block_id -> (R, G, B)
+    Returns (palette_rgb, palette_ids): a read-only (P, 3) uint8 array of block colors
+    and the tuple of the P matching block ids, in the same order.
+    Results are cached per file (by normalized path and modification time), so repeated
+    runs in the same process do not parse the JSON again.
+    """
+    path = os.path.realpath(rgb_json_path)
+    return _load_rgb_data(path, os.path.getmtime(path))
+
+@functools.lru_cache(maxsize=4)
+def _load_rgb_data(rgb_json_path, mtime):
+    if orjson is not None:
+        with open(rgb_json_path, "rb") as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(rgb_json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    palette_rgb = np.array(list(data.values()), dtype=np.uint8).reshape(-1, 3)
+    palette_rgb.setflags(write=False)
+    palette_ids = tuple(data.keys())
+    return palette_rgb, palette_ids
+
+def color_distances(colors, palette_rgb, metric="euclidean"):
+    """
+    Returns the (N, P) matrix of distances between N RGB colors and the P palette colors.
+    "euclidean" gives squared Euclidean distances; "manhattan" gives L1 distances (sum of
+    absolute channel differences), which stay within int16 for 8-bit colors and are
+    cheaper to compute.
+    """
+    colors = np.asarray(colors)
+    if metric == "manhattan":
+        return np.abs(colors[:, None, :].astype(np.int16) - palette_rgb[None, :, :].astype(np.int16)).sum(-1)
+    if metric == "euclidean":
+        # |c - p|^2 expanded as |c|^2 - 2 c.p + |p|^2 to avoid a (N, P, 3) temporary.
+        colors = colors.astype(np.int32)
+        palette = palette_rgb.astype(np.int32)
+        return (colors**2).sum(1)[:, None] - 2 * (colors @ palette.T) + (palette**2).sum(1)[None, :]
+    raise ValueError(f"Unknown color metric: {metric}")
+
+def find_closest_block(r, g, b, palette_rgb, palette_ids, metric="euclidean"):
+    """
+    Given an (r, g, b) color, find the block of the palette
+    whose color is closest by the given metric (see color_distances).
+    """
+    if not palette_ids:
+        return None
+    return palette_ids[int(color_distances([[r, g, b]], palette_rgb, metric)[0].argmin())]
+
+def build_block_lut(palette_rgb, metric="euclidean"):
+    """
+    Precomputes a quantized RGB -> block lookup table. Each channel is reduced to its
+    top 5 bits and the three are packed into a 15-bit index (see lut_index); every one
+    of the 32768 bins is mapped to the block closest (by the given metric) to the bin's
+    center color, using a k-d tree query over the palette.
+    Returns a flat, read-only (32768,) uint16 table (64 KB) of indices into the palette.
+    Tables are cached per palette and metric.
+    """
+    palette = np.ascontiguousarray(palette_rgb, dtype=np.uint8)
+    return _build_block_lut(palette.tobytes(), metric)
+
+@functools.lru_cache(maxsize=4)
+def _build_block_lut(palette_bytes, metric):
+    palette_rgb = np.frombuffer(palette_bytes, dtype=np.uint8).reshape(-1, 3)
+    centers = np.arange(4, 256, 8)
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing="ij"), axis=-1).reshape(-1, 3)
+    tree = cKDTree(palette_rgb.astype(np.float64))
+    _, idx = tree.query(grid, k=1, p=1 if metric == "manhattan" else 2)
+    lut = idx.astype(np.uint16)
+    lut.setflags(write=False)
+    return lut
+
+def lut_index(colors):
+    """
+    Packs an (N, 3) array of 8-bit RGB colors into 15-bit build_block_lut indices:
+    ((r >> 3) << 10) | ((g >> 3) << 5) | (b >> 3).
+    """
+    colors = colors.astype(np.uint32)
+    return ((colors[:, 0] >> 3) << 10) | ((colors[:, 1] >> 3) << 5) | (colors[:, 2] >> 3)
+
+def find_closest_blocks(colors, palette_rgb, palette_ids, metric="euclidean"):
+    """
+    Vectorized version of find_closest_block for an (N, 3) array of RGB colors.
+    The palette is indexed in a k-d tree and each distinct color is only queried once.
+    Returns a list of N block ids.
     """
-    with open(rgb_json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    block_rgb_map = {}
-    for block_id, rgb_list in data.items():
-        block_rgb_map[block_id] = tuple(rgb_list)
-    return block_rgb_map
+    tree = cKDTree(palette_rgb.astype(np.float64))
+    unique_colors, inverse = np.unique(colors, axis=0, return_inverse=True)
+    _, idx = tree.query(unique_colors, k=1, p=1 if metric == "manhattan" else 2)
+    return np.take(palette_ids, idx[inverse.ravel()]).tolist()
 
-def find_closest_block(r, g, b, block_rgb_map):
+def match_colors(colors, palette_rgb, palette_ids, exact_colors=False, metric="euclidean"):
     """
-    Given an (r, g, b) color, find the block in block_rgb_map
-    whose color is closest by Euclidean distance.
+    Maps an (N, 3) array of RGB colors to a list of N block ids, either exactly
+    (find_closest_blocks) or through the quantized lookup table (build_block_lut).
     """
-    closest_block = None
-    closest_distance_sq = float('inf')
-    for block_id, (br, bg, bb) in block_rgb_map.items():
-        dist_sq = (r - br)**2 + (g - bg)**2 + (b - bb)**2
-        if dist_sq < closest_distance_sq:
-            closest_distance_sq = dist_sq
-            closest_block = block_id
-    return closest_block
+    if exact_colors:
+        return find_closest_blocks(colors, palette_rgb, palette_ids, metric)
+    lut = build_block_lut(palette_rgb, metric=metric)
+    block_idx = lut[lut_index(colors)]
+    return np.take(palette_ids, block_idx).tolist()
 
 ##############################################################################
 #                   PERSPECTIVE PLANE GENERATION
@@ -105,23 +200,302 @@ def generate_plane_commands(distance, base_distance, plane_width, plane_height,
         plane_center[2] - half_width * right_vector[2] + half_height * true_up_vector[2]
     )
 
+    # Offsets of every column along the right vector and every row down the up vector.
+    step = pixel_scale * scale_factor
+    col_steps = np.arange(plane_width) * step
+    row_steps = np.arange(plane_height) * step
+    offsets = (col_steps[None, :, None] * np.asarray(right_vector)
+               - row_steps[:, None, None] * np.asarray(true_up_vector))
+
+    coords = np.rint(np.asarray(top_left) + offsets).astype(np.int64).reshape(-1, 3)
+    return format_setblock_commands(coords, block_id)
+
+##############################################################################
+#                      PIXEL TO BLOCK KERNELS
+##############################################################################
+
+def _view_coords(depth_map, row_idx, col_idx, output_width, output_height, base_distance):
+    """
+    Returns the (K, 3) camera-space coordinates of the K pixels at (row_idx, col_idx):
+    their distance along the look vector and their perspective-scaled offsets along
+    the right and up vectors. Only the requested pixels are computed.
+    """
+    height, width = depth_map.shape
+    center_x = width / 2.0
+    center_y = height / 2.0
+    
+    distance = depth_map[row_idx, col_idx].astype(np.float64)
+    scale_factor = distance / base_distance
+    
+    # Invert left/right by multiplying by -1.
+    norm_offset_right = -((col_idx - center_x) / (width / 2)) * (output_width / 2) * scale_factor
+    norm_offset_up = ((center_y - row_idx) / (height / 2)) * (output_height / 2) * scale_factor
+    return np.stack([distance, norm_offset_right, norm_offset_up], axis=-1)
+
+def _build_far_cell_blocks(rgba, depth_map, eye_pos, look_vector, right_vector, true_up_vector,
+                           output_width, output_height, base_distance, far_threshold,
+                           pixel_scale, palette_rgb, palette_ids, exact_colors, color_metric,
+                           max_depth_step=4.0):
+    """
+    Handles the far region at half resolution. The image is split into 2x2 pixel cells,
+    and every cell whose four pixels are all visible and far, and whose four neighbouring
+    cells are too and lie within max_depth_step of its mean depth, is drawn as a single
+    2x2 block square centered on the cell's mean position, using the cell's most common
+    block. Cells on a border keep the per-pixel path, so merging opens no holes.
+    Returns (coords, block_ids, active), where active marks the pixels that are
+    still left for the per-pixel kernels.
+    """
+    height, width = depth_map.shape
+    cell_rows, cell_cols = height // 2, width // 2
+    
+    def cells(grid):
+        # (H, W, ...) -> (H // 2, W // 2, 4, ...), dropping an odd last row/column.
+        cropped = grid[:2 * cell_rows, :2 * cell_cols]
+        split = cropped.reshape(cell_rows, 2, cell_cols, 2, *grid.shape[2:]).swapaxes(1, 2)
+        return split.reshape(cell_rows, cell_cols, 4, *grid.shape[2:])
+    
+    visible = rgba[..., 3] >= 128
+    # An image one pixel tall or wide has no 2x2 cells; every pixel goes per-pixel.
+    if cell_rows == 0 or cell_cols == 0:
+        return np.empty((0, 3), np.int64), [], visible
+    far_cell = cells(visible & (depth_map >= far_threshold)).all(-1)
+    
+    # Neighbouring squares only overlap where their depths are close, so a cell is merged
+    # only if its four neighbours are far cells within max_depth_step of its mean depth.
+    # The border is padded with non-far cells, so the padded depth value never matters.
+    cell_depth = cells(depth_map).mean(-1)
+    padded_far = np.pad(far_cell, 1)
+    padded_depth = np.pad(cell_depth, 1)
+    interior = far_cell.copy()
+    for dr, dc in ((0, 1), (2, 1), (1, 0), (1, 2)):
+        interior &= padded_far[dr:dr + cell_rows, dc:dc + cell_cols]
+        interior &= np.abs(padded_depth[dr:dr + cell_rows, dc:dc + cell_cols] - cell_depth) <= max_depth_step
+    far_cell = interior
+    active = visible.copy()
+    active[:2 * cell_rows, :2 * cell_cols] &= ~far_cell.repeat(2, 0).repeat(2, 1)
+    
+    # Project the mean camera-space coordinates of each cell; the pixels of a cell are
+    # ordered top-left, top-right, bottom-left, bottom-right, as in cells().
+    cell_row, cell_col = np.nonzero(far_cell)
+    row_idx = (2 * cell_row[:, None] + np.array([0, 0, 1, 1])).ravel()
+    col_idx = (2 * cell_col[:, None] + np.array([0, 1, 0, 1])).ravel()
+    view_coords = _view_coords(depth_map, row_idx, col_idx, output_width, output_height, base_distance)
+    view_coords = view_coords.reshape(-1, 4, 3).mean(1)
+    basis = np.array([look_vector, right_vector, true_up_vector], dtype=np.float64)
+    cell_pos = eye_pos + view_coords @ basis
+    # The square is centered on the cell so that it overlaps its neighbours evenly.
+    step = pixel_scale * view_coords[:, 0] / base_distance
+    half_r = 0.5 * step[:, None] * right_vector
+    half_u = 0.5 * step[:, None] * true_up_vector
+    positions = np.stack([cell_pos - half_r - half_u, cell_pos + half_r - half_u,
+                          cell_pos - half_r + half_u, cell_pos + half_r + half_u], axis=1)
+    coords = np.rint(positions.reshape(-1, 3)).astype(np.int64)
+    
+    # Mode filter: the most frequent block of the four pixels (first one on ties).
+    cell_colors = rgba[row_idx, col_idx, :3]
+    cell_block_ids = match_colors(cell_colors, palette_rgb, palette_ids, exact_colors, color_metric)
+    names, codes = np.unique(np.array(cell_block_ids), return_inverse=True)
+    codes = codes.reshape(-1, 4)
+    counts = (codes[:, :, None] == codes[:, None, :]).sum(2)
+    mode = codes[np.arange(len(codes)), counts.argmax(1)]
+    block_ids = names[mode].repeat(4).tolist()
+    return coords, block_ids, active
+
+def _build_blocks_numpy(rgba, depth_map, eye_pos, look_vector, right_vector, true_up_vector,
+                        output_width, output_height, base_distance, far_threshold,
+                        pixel_scale, palette_rgb, palette_ids, exact_colors, color_metric, active):
+    """
+    Computes the world position and block id of every block to place for the pixels
+    marked in active, using NumPy broadcasting over the whole image.
+    Returns (coords, block_ids): an (N, 3) integer array and a list of N block ids.
+    """
+    # Only the active pixels go through the projection and color matching.
+    row_idx, col_idx = np.nonzero(active)
+    view_coords = _view_coords(depth_map, row_idx, col_idx, output_width, output_height, base_distance)
+    distance = view_coords[:, 0]
+    scale_factor = distance / base_distance
+    is_far = distance >= far_threshold
+    
+    # Project every pixel with a single matrix product against the camera basis.
+    basis = np.array([look_vector, right_vector, true_up_vector], dtype=np.float64)
+    block_pos = eye_pos + view_coords @ basis
+    
+    # Use the pixel's RGB for block mapping.
+    block_ids = match_colors(rgba[row_idx, col_idx, :3], palette_rgb, palette_ids, exact_colors, color_metric)
+    
+    # Far pixels outside of a full far cell keep the doubled block area:
+    # they get their base position plus the right, up and right+up corners.
+    delta_r = (pixel_scale * scale_factor)[:, None] * right_vector
+    delta_u = (pixel_scale * scale_factor)[:, None] * true_up_vector
+    positions = np.stack([
+        block_pos,
+        block_pos + delta_r,
+        block_pos + delta_u,
+        block_pos + delta_r + delta_u,
+    ], axis=1)
+    keep = np.zeros(positions.shape[:2], dtype=bool)
+    keep[:, 0] = True
+    keep[is_far, 1:] = True
+    
+    coords = np.rint(positions[keep]).astype(np.int64)
+    owners = np.broadcast_to(np.arange(len(block_ids))[:, None], keep.shape)[keep]
+    return coords, [block_ids[i] for i in owners.tolist()]
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _build_blocks_kernel(rgba, depth_map, eye_pos, look_vector, right_vector, true_up_vector,
+                             output_width, output_height, base_distance, far_threshold,
+                             pixel_scale, lut, active, out_xyz, out_bid, out_count):
+        """
+        Per-pixel body of _build_blocks_compiled. Each row writes into its own slice of
+        out_xyz/out_bid (room for 4 blocks per pixel) and records how many it used
+        in out_count, so rows can run in parallel without atomics.
+        """
+        height, width = depth_map.shape
+        center_x = width / 2.0
+        center_y = height / 2.0
+        for row in numba.prange(height):
+            count = 0
+            for col in range(width):
+                if not active[row, col]:
+                    continue
+                r, g, b = np.uint32(rgba[row, col, 0]), np.uint32(rgba[row, col, 1]), np.uint32(rgba[row, col, 2])
+                block_idx = lut[((r >> 3) << 10) | ((g >> 3) << 5) | (b >> 3)]
+                
+                distance = np.float64(depth_map[row, col])
+                scale_factor = distance / base_distance
+                norm_offset_right = -((col - center_x) / (width / 2)) * (output_width / 2) * scale_factor
+                norm_offset_up = ((center_y - row) / (height / 2)) * (output_height / 2) * scale_factor
+                step = pixel_scale * scale_factor
+                
+                # Corners 1-3 (right, up, right+up) are only drawn for far pixels.
+                n_corners = 4 if distance >= far_threshold else 1
+                for corner in range(n_corners):
+                    for k in range(3):
+                        pos = (eye_pos[k] + look_vector[k] * distance
+                               + right_vector[k] * norm_offset_right + true_up_vector[k] * norm_offset_up)
+                        if corner & 1:
+                            pos += step * right_vector[k]
+                        if corner & 2:
+                            pos += step * true_up_vector[k]
+                        out_xyz[row, count, k] = np.int32(np.rint(pos))
+                    out_bid[row, count] = block_idx
+                    count += 1
+            out_count[row] = count
+
+else:
+    _build_blocks_kernel = _cython_build_blocks
+
+def _build_blocks_compiled(rgba, depth_map, eye_pos, look_vector, right_vector, true_up_vector,
+                           output_width, output_height, base_distance, far_threshold,
+                           pixel_scale, palette_rgb, palette_ids, exact_colors, color_metric, active):
+    """
+    Same as _build_blocks_numpy, but runs the per-pixel loop as a compiled kernel
+    (parallel Numba if available, otherwise the Cython extension).
+    Colors are always mapped through the quantized lookup table.
+    """
+    lut = build_block_lut(palette_rgb, metric=color_metric)
+    height, width = depth_map.shape
+    out_xyz = np.empty((height, width * 4, 3), dtype=np.int32)
+    out_bid = np.empty((height, width * 4), dtype=np.int64)
+    out_count = np.zeros(height, dtype=np.int64)
+    _build_blocks_kernel(np.ascontiguousarray(rgba), np.ascontiguousarray(depth_map, dtype=np.float32), eye_pos,
+                         look_vector, right_vector, true_up_vector, float(output_width), float(output_height),
+                         float(base_distance), float(far_threshold), float(pixel_scale), lut,
+                         active.view(np.uint8), out_xyz, out_bid, out_count)
+    
+    # Gather the used part of every row, keeping row-major command order.
+    filled = np.arange(width * 4)[None, :] < out_count[:, None]
+    return out_xyz[filled], np.take(palette_ids, out_bid[filled]).tolist()
+
+##############################################################################
+#                          COMMAND GENERATION
+##############################################################################
+
+def dedupe_blocks(coords, block_ids):
+    """
+    Drops block placements whose cell is placed again later on, keeping only the last
+    placement of every (x, y, z) cell, which is the one that would end up in the world.
+    The remaining placements keep their relative order.
+    Returns (coords, block_ids).
+    """
+    if len(coords) == 0:
+        return coords, list(block_ids)
+    # Pack each cell into a single int64 key, relative to the bounding box of all cells.
+    offsets = (coords - coords.min(0)).astype(np.int64)
+    spans = offsets.max(0) + 1
+    keys = (offsets[:, 0] * spans[1] + offsets[:, 1]) * spans[2] + offsets[:, 2]
+    
+    # First occurrence in the reversed keys is the last one in the original order.
+    _, first_in_reversed = np.unique(keys[::-1], return_index=True)
+    keep = np.sort(len(keys) - 1 - first_in_reversed)
+    return coords[keep], np.asarray(block_ids, dtype=object)[keep].tolist()
+
+def format_setblock_commands(coords, block_ids):
+    """
+    Formats one setblock command per row of an (N, 3) integer coordinate array.
+    block_ids is either a single block id or a sequence of N block ids.
+    Each distinct coordinate value is converted to a string only once, through a
+    per-axis lookup table, and the commands are assembled by element-wise string
+    concatenation instead of formatting every command separately.
+    """
+    coords = np.asarray(coords)
+    if len(coords) == 0:
+        return []
+    parts = []
+    for k in range(3):
+        low = int(coords[:, k].min())
+        table = np.array([f"{v} " for v in range(low, int(coords[:, k].max()) + 1)], dtype=object)
+        parts.append(table[coords[:, k] - low])
+    if not isinstance(block_ids, str):
+        block_ids = np.asarray(block_ids, dtype=object)
+    return ("setblock " + parts[0] + parts[1] + parts[2] + block_ids).tolist()
+
+def build_fill_commands(coords, block_ids):
+    """
+    Turns a sequence of block placements into commands, collapsing consecutive placements
+    of the same block that form a straight, axis-aligned line of adjacent cells into a
+    single fill command. Placements that are not part of such a run stay setblock commands.
+    Only consecutive placements are merged, so the result is equivalent to placing the
+    blocks one by one in the original order.
+    """
+    # With fewer than two placements there is nothing to merge.
+    if len(coords) < 2:
+        return format_setblock_commands(coords, block_ids)
+    block_ids = np.asarray(block_ids)
+    
+    # Classify every link between consecutive placements by its unit step direction
+    # (0-5 for -x, +x, -y, +y, -z, +z), or -1 if the two cannot share a fill.
+    step = np.diff(coords, axis=0)
+    axis = np.abs(step).argmax(1)
+    is_unit_step = (np.abs(step).sum(1) == 1) & (block_ids[1:] == block_ids[:-1])
+    direction = np.where(is_unit_step, 2 * axis + (step[np.arange(len(step)), axis] > 0), -1)
+    
+    # Walk the segments of equal direction; a placement shared by two segments
+    # goes to the first one.
+    boundaries = np.flatnonzero(np.diff(direction)) + 1
+    seg_starts = np.concatenate(([0], boundaries))
+    seg_ends = np.concatenate((boundaries, [len(direction)]))
+    runs = []
+    next_free = 0
+    for start, end, code in zip(seg_starts.tolist(), seg_ends.tolist(), direction[seg_starts].tolist()):
+        start = max(start, next_free)
+        if code == -1 or start >= end:
+            continue
+        runs.append((start, end))
+        next_free = end + 1
+    
+    setblock_commands = format_setblock_commands(coords, block_ids)
+    coords = coords.tolist()
+    block_ids = block_ids.tolist()
     commands = []
-    for row in range(plane_height):
-        for col in range(plane_width):
-            offset_x = (col * pixel_scale * scale_factor) * right_vector[0] - (row * pixel_scale * scale_factor) * true_up_vector[0]
-            offset_y = (col * pixel_scale * scale_factor) * right_vector[1] - (row * pixel_scale * scale_factor) * true_up_vector[1]
-            offset_z = (col * pixel_scale * scale_factor) * right_vector[2] - (row * pixel_scale * scale_factor) * true_up_vector[2]
-
-            block_pos = (
-                top_left[0] + offset_x,
-                top_left[1] + offset_y,
-                top_left[2] + offset_z
-            )
-            bx = int(round(block_pos[0]))
-            by = int(round(block_pos[1]))
-            bz = int(round(block_pos[2]))
-            cmd = f"setblock {bx} {by} {bz} {block_id}"
-            commands.append(cmd)
+    pos = 0
+    for start, end in runs + [(len(coords), len(coords))]:
+        commands.extend(setblock_commands[pos:start])
+        if start < end:
+            (x1, y1, z1), (x2, y2, z2) = coords[start], coords[end]
+            commands.append(f"fill {x1} {y1} {z1} {x2} {y2} {z2} {block_ids[start]}")
+        pos = end + 1
     return commands
 
 ##############################################################################
@@ -143,7 +517,8 @@ def get_depth_map(image_path, min_distance, max_distance):
 
 def process_image_depthmap_and_get_commands(image_path, rgb_json_path, player_info,
                                             min_distance=60.0, max_distance=180.0,
-                                            pixel_scale=1, output_width=400, output_height=None):
+                                            pixel_scale=1, output_width=400, output_height=None,
+                                            exact_colors=False, color_metric="euclidean", use_fill=True):
     """
     Processes an image by first resizing it to the desired output dimensions and then generating
     a block placement command for each pixel. The image is converted to a depth map so that each pixel 
@@ -156,14 +531,21 @@ def process_image_depthmap_and_get_commands(image_path, rgb_json_path, player_in
     
     Also, for pixels whose computed distance is in the farthest 20% of the range,
     the block is drawn double in width and height (i.e. a 2×2 block square is generated).
+    Where a whole 2×2 group of pixels is far, and so are the groups around it at a similar
+    depth, the group is drawn as a single 2×2 square instead of one square per pixel.
     
     Parameters:
       - output_width: The desired width (in pixels) of the resized image.
       - output_height: The desired height (in pixels) of the resized image. If None, the aspect ratio
         of the original image is maintained.
+      - exact_colors: If True, every distinct pixel color is matched exactly with a k-d tree query
+        instead of going through the quantized RGB lookup table.
+      - color_metric: "euclidean" (default) or "manhattan"; the distance used to pick the closest block.
+      - use_fill: If True, runs of adjacent, identical blocks along a straight line are placed
+        with a single fill command instead of one setblock per block.
     """
     # Load the block RGB mapping.
-    block_rgb_map = load_rgb_data(rgb_json_path)
+    palette_rgb, palette_ids = load_rgb_data(rgb_json_path)
     
     # Open the original image in RGBA.
     orig_im = Image.open(image_path).convert("RGBA")
@@ -173,102 +555,53 @@ def process_image_depthmap_and_get_commands(image_path, rgb_json_path, player_in
     
     # Resize the image to control the number of commands generated.
     im = orig_im.resize((output_width, output_height), Image.LANCZOS)
+    rgba = np.asarray(im)  # (H, W, 4) array of RGBA values.
     
-    # Create the flipped depth map from the resized image.
-    im_gray = im.convert("L")
-    arr = np.array(im_gray, dtype=np.float32)
-    normalized = arr / 255.0
-    depth_map = max_distance - normalized * (max_distance - min_distance)
-    
-    width, height = im.size
-    pixel_data = im.load()  # Now returns RGBA tuples.
-    
-    # Compute the image center.
-    center_x = width / 2.0
-    center_y = height / 2.0
+    # Create the flipped depth map from the resized pixels, using the ITU-R BT.601
+    # luma weights (the same ones as PIL's "L" mode) instead of a second image conversion.
+    gray = rgba[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    depth_map = max_distance - (gray / 255.0) * (max_distance - min_distance)
     
     # Compute the player's eye position.
     px, py, pz = player_info["pos"]
     eye_height = 1.62  # Typical Minecraft eye height.
-    eye_pos = (px, py + eye_height, pz)
+    eye_pos = np.array([px, py + eye_height, pz], dtype=np.float64)
     
     # Compute the look vector from yaw and pitch.
     yaw, pitch = player_info["rot"]
     yaw_rad = math.radians(yaw)
     pitch_rad = math.radians(pitch)
-    dx = -math.sin(yaw_rad) * math.cos(pitch_rad)
-    dy = -math.sin(pitch_rad)
-    dz = math.cos(yaw_rad) * math.cos(pitch_rad)
-    look_vector = (dx, dy, dz)
+    cos_yaw, sin_yaw = math.cos(yaw_rad), math.sin(yaw_rad)
+    cos_pitch, sin_pitch = math.cos(pitch_rad), math.sin(pitch_rad)
+    look_vector = np.array([-sin_yaw * cos_pitch, -sin_pitch, cos_yaw * cos_pitch])
     
     # Compute the right and true-up vectors.
-    approximate_up = (0, 1, 0)
+    approximate_up = np.array([0.0, 1.0, 0.0])
     if abs(dot(look_vector, approximate_up)) > 0.99:
-        approximate_up = (1, 0, 0)
+        approximate_up = np.array([1.0, 0.0, 0.0])
     right_vector = normalize(cross(approximate_up, look_vector))
     true_up_vector = normalize(cross(look_vector, right_vector))
     
     base_distance = max_distance  # Reference for perspective scaling.
-    commands = []
     
     # Define threshold: farthest 40% of the distance range.
     far_threshold = min_distance + 0.6 * (max_distance - min_distance)
     
-    # Process each pixel.
-    for row in range(height):
-        for col in range(width):
-            pixel = pixel_data[col, row]  # (R, G, B, A)
-            alpha_val = pixel[3]
-            # Skip pixels that are too transparent (alpha below 50%).
-            if alpha_val < 128:
-                continue
-            
-            # Use the pixel's RGB for block mapping.
-            color = pixel[:3]
-            block_id = find_closest_block(color[0], color[1], color[2], block_rgb_map)
-            if block_id is None:
-                block_id = "minecraft:stone"
-            
-            distance = float(depth_map[row, col])
-            scale_factor = distance / base_distance
-            
-            # Invert left/right by multiplying by -1.
-            norm_offset_right = -((col - center_x) / (width / 2)) * (output_width / 2) * scale_factor
-            norm_offset_up = ((center_y - row) / (height / 2)) * (output_height / 2) * scale_factor
-            
-            block_pos = (
-                eye_pos[0] + look_vector[0] * distance + right_vector[0] * norm_offset_right + true_up_vector[0] * norm_offset_up,
-                eye_pos[1] + look_vector[1] * distance + right_vector[1] * norm_offset_right + true_up_vector[1] * norm_offset_up,
-                eye_pos[2] + look_vector[2] * distance + right_vector[2] * norm_offset_right + true_up_vector[2] * norm_offset_up,
-            )
-            
-            # If the pixel is in the farthest 20% of the depth range, double the block area.
-            if distance >= far_threshold:
-                delta_r = (pixel_scale * scale_factor * right_vector[0],
-                           pixel_scale * scale_factor * right_vector[1],
-                           pixel_scale * scale_factor * right_vector[2])
-                delta_u = (pixel_scale * scale_factor * true_up_vector[0],
-                           pixel_scale * scale_factor * true_up_vector[1],
-                           pixel_scale * scale_factor * true_up_vector[2])
-                
-                positions = [
-                    block_pos,
-                    (block_pos[0] + delta_r[0], block_pos[1] + delta_r[1], block_pos[2] + delta_r[2]),
-                    (block_pos[0] + delta_u[0], block_pos[1] + delta_u[1], block_pos[2] + delta_u[2]),
-                    (block_pos[0] + delta_r[0] + delta_u[0], block_pos[1] + delta_r[1] + delta_u[1], block_pos[2] + delta_r[2] + delta_u[2])
-                ]
-                for pos in positions:
-                    bx = int(round(pos[0]))
-                    by = int(round(pos[1]))
-                    bz = int(round(pos[2]))
-                    cmd = f"setblock {bx} {by} {bz} {block_id}"
-                    commands.append(cmd)
-            else:
-                bx = int(round(block_pos[0]))
-                by = int(round(block_pos[1]))
-                bz = int(round(block_pos[2]))
-                cmd = f"setblock {bx} {by} {bz} {block_id}"
-                commands.append(cmd)
+    # Far 2x2 cells are drawn at half resolution; the remaining visible pixels
+    # (alpha of at least 50%) go through the per-pixel kernel.
+    params = (rgba, depth_map, eye_pos, look_vector, right_vector, true_up_vector,
+              output_width, output_height, base_distance, far_threshold,
+              pixel_scale, palette_rgb, palette_ids, exact_colors, color_metric)
+    far_coords, far_block_ids, active = _build_far_cell_blocks(*params)
+    build_blocks = _build_blocks_numpy if exact_colors or _build_blocks_kernel is None else _build_blocks_compiled
+    coords, block_ids = build_blocks(*params, active)
+    coords = np.concatenate([coords, far_coords])
+    block_ids = block_ids + far_block_ids
+    coords, block_ids = dedupe_blocks(coords, block_ids)
+    if use_fill:
+        commands = build_fill_commands(coords, block_ids)
+    else:
+        commands = format_setblock_commands(coords, block_ids)
     
     print(f"Generated {len(commands)} commands for image processing.")
     return commands
@@ -3,7 +3,7 @@ import json
 from mcrcon import MCRcon
 
 from image_processing import parse_list_response, process_image_depthmap_and_get_commands
-from send_commands import send_commands
+from send_commands import run_datapack_functions, send_commands, write_datapack_functions
 
 def main():
     # Define base directories and file paths
@@ -32,6 +32,7 @@ def main():
     port = 25575
     password = "" # PASSWORD HERE
     player_name = "" # PLAYER NAME HERE
+    world_dir = "" # OPTIONAL: PATH TO THE SERVER'S WORLD FOLDER, TO UPLOAD COMMANDS AS A DATAPACK
 
     # Check for empty RCON credentials
     if not password or not player_name:
@@ -55,8 +56,14 @@ def main():
     # Process the image to get the list of setblock commands
     commands = process_image_depthmap_and_get_commands(image_path, rgb_json_path, player_info)
     
-    # Send the commands to Minecraft via RCON
-    send_commands(commands, host, port, password)
+    # If the server's world folder is reachable, write the commands as a datapack function
+    # and only send the calls to run it; otherwise stream the commands via RCON.
+    if world_dir:
+        calls = write_datapack_functions(commands, world_dir)
+        print(f"Wrote {len(commands)} commands to a datapack in {world_dir}.")
+        run_datapack_functions(calls, host, port, password)
+    else:
+        send_commands(commands, host, port, password)
 
 if __name__ == "__main__":
     main()
@@ -1,45 +1,181 @@
-import queue
-import concurrent.futures
-from mcrcon import MCRcon
+import asyncio
+import hashlib
+import json
+import os
+import struct
 
-class RCONConnectionPool:
-    def __init__(self, host, password, port, pool_size):
-        self.pool = queue.Queue()
+# Packet types of the (Source) RCON protocol used by Minecraft.
+SERVERDATA_RESPONSE_VALUE = 0
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_AUTH = 3
+
+class RCONError(Exception):
+    pass
+
+class AsyncRCONClient:
+    """
+    Minimal asyncio RCON client owning one persistent socket.
+    A packet is a little-endian int32 length, int32 request id and int32 type,
+    followed by the ASCII/UTF-8 payload and two null bytes.
+    """
+    def __init__(self, host, password, port):
         self.host = host
         self.password = password
         self.port = port
-        for _ in range(pool_size):
-            conn = MCRcon(host, password, port=port)
-            conn.connect()
-            self.pool.put(conn)
-    
-    def get(self):
-        return self.pool.get()
-    
-    def put(self, conn):
-        self.pool.put(conn)
-    
-    def close_all(self):
-        while not self.pool.empty():
-            conn = self.pool.get()
-            conn.disconnect()
-
-def send_commands(commands, host, port, password, pool_size=16):
-    """
-    Sends a list of setblock commands to the Minecraft server using a connection pool.
-    """
-    pool = RCONConnectionPool(host, password, port, pool_size)
-
-    def send_block_command(cmd):
-        conn = pool.get()
-        try:
-            return conn.command(cmd)
-        finally:
-            pool.put(conn)
-
-    print(f"Sending {len(commands)} setblock commands using a connection pool...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size) as executor:
-        results = list(executor.map(send_block_command, commands))
-    pool.close_all()
+        self.reader = None
+        self.writer = None
+        self.next_id = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self._send_packet(SERVERDATA_AUTH, self.password)
+        await self.writer.drain()
+        request_id, _, _ = await self._read_packet()
+        if request_id == -1:
+            raise RCONError("RCON login failed, check the password.")
+
+    def _send_packet(self, packet_type, payload):
+        self.next_id += 1
+        body = struct.pack("<ii", self.next_id, packet_type) + payload.encode("utf-8") + b"\x00\x00"
+        self.writer.write(struct.pack("<i", len(body)) + body)
+        return self.next_id
+
+    async def _read_packet(self):
+        (length,) = struct.unpack("<i", await self.reader.readexactly(4))
+        data = await self.reader.readexactly(length)
+        request_id, packet_type = struct.unpack("<ii", data[:8])
+        return request_id, packet_type, data[8:-2].decode("utf-8")
+
+    async def command(self, cmd):
+        self._send_packet(SERVERDATA_EXECCOMMAND, cmd)
+        await self.writer.drain()
+        _, _, payload = await self._read_packet()
+        return payload
+
+    async def pipeline(self, cmds):
+        """
+        Sends all commands back to back, then collects the responses, so the round-trip
+        time is paid once per batch instead of once per command. Responses are matched
+        to their commands by request id.
+        Assumes every response fits in a single packet (true for setblock and fill), and
+        a server that accepts several packets per socket read, which vanilla does not.
+        """
+        request_ids = [self._send_packet(SERVERDATA_EXECCOMMAND, cmd) for cmd in cmds]
+        await self.writer.drain()
+        responses = {}
+        while len(responses) < len(request_ids):
+            request_id, _, payload = await self._read_packet()
+            responses[request_id] = payload
+        return [responses[request_id] for request_id in request_ids]
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+def write_datapack_functions(commands, world_dir, namespace="anamorph", max_function_length=50000):
+    """
+    Writes the commands into a datapack in the world's datapacks folder, as one or more
+    .mcfunction files of at most max_function_length commands each (the server stops a
+    function chain after maxCommandChainLength commands, 65536 by default).
+    The file names carry a hash of the commands, so a call can never run the function
+    of an earlier image that the server still has loaded.
+    Returns the function calls that run them, one per file; see run_datapack_functions.
+    """
+    pack_dir = os.path.join(world_dir, "datapacks", namespace)
+    # Minecraft 1.21+ layout (pack_format 48, singular "function" folder).
+    function_dir = os.path.join(pack_dir, "data", namespace, "function")
+    os.makedirs(function_dir, exist_ok=True)
+    for name in os.listdir(function_dir):
+        if name.startswith("paint_") and name.endswith(".mcfunction"):
+            os.remove(os.path.join(function_dir, name))
+
+    with open(os.path.join(pack_dir, "pack.mcmeta"), "w", encoding="utf-8") as f:
+        json.dump({"pack": {"pack_format": 48, "description": "Anamorphic image"}}, f)
+
+    digest = hashlib.sha1("\n".join(commands).encode("utf-8")).hexdigest()[:12]
+    calls = []
+    for part, start in enumerate(range(0, len(commands), max_function_length)):
+        name = f"paint_{digest}_{part}"
+        with open(os.path.join(function_dir, f"{name}.mcfunction"), "w", encoding="utf-8") as f:
+            f.write("\n".join(commands[start:start + max_function_length]) + "\n")
+        calls.append(f"function {namespace}:{name}")
+    return calls
+
+async def _run_datapack_functions_async(calls, host, port, password, retry_delay, max_attempts):
+    client = AsyncRCONClient(host, password, port)
+    try:
+        await client.connect()
+        await client.command("reload")
+        # reload returns before the new datapack is loaded: retry the first call until
+        # the server knows the function (an unknown function is not run at all).
+        for _ in range(max_attempts):
+            response = await client.command(calls[0])
+            if "Unknown function" not in response:
+                break
+            await asyncio.sleep(retry_delay)
+        else:
+            raise RCONError(f"The server did not load {calls[0]!r} after the reload.")
+        return [response] + [await client.command(call) for call in calls[1:]]
+    finally:
+        await client.close()
+
+def run_datapack_functions(calls, host, port, password, retry_delay=0.5, max_attempts=120):
+    """
+    Reloads the server's datapacks and runs the function calls returned by
+    write_datapack_functions over a single RCON connection. The calls are only sent once
+    the reload has finished, which is detected by retrying the first call every
+    retry_delay seconds until it is no longer an unknown function.
+    Returns the server's response to every call, in order.
+    """
+    # Nothing was written (e.g. a fully transparent image), so there is nothing to run.
+    if not calls:
+        return []
+    print(f"Reloading datapacks and running {len(calls)} functions...")
+    results = asyncio.run(_run_datapack_functions_async(calls, host, port, password, retry_delay, max_attempts))
+    print("Done placing the image in 3D!")
+    return results
+
+async def _send_commands_async(commands, host, port, password, pool_size, chunk_size, pipeline_depth):
+    queue = asyncio.Queue()
+    for start in range(0, len(commands), chunk_size):
+        queue.put_nowait(start)
+    results = [None] * len(commands)
+
+    async def worker(client):
+        # Each worker owns one connection and keeps pulling chunks until none are left.
+        while not queue.empty():
+            start = queue.get_nowait()
+            end = min(start + chunk_size, len(commands))
+            if pipeline_depth <= 1:
+                for i in range(start, end):
+                    results[i] = await client.command(commands[i])
+            else:
+                for batch in range(start, end, pipeline_depth):
+                    batch_end = min(batch + pipeline_depth, end)
+                    results[batch:batch_end] = await client.pipeline(commands[batch:batch_end])
+
+    clients = [AsyncRCONClient(host, password, port) for _ in range(pool_size)]
+    try:
+        await asyncio.gather(*(client.connect() for client in clients))
+        await asyncio.gather(*(worker(client) for client in clients))
+    finally:
+        await asyncio.gather(*(client.close() for client in clients))
+    return results
+
+def send_commands(commands, host, port, password, pool_size=16, chunk_size=100, pipeline_depth=1):
+    """
+    Sends a list of setblock commands to the Minecraft server over pool_size persistent
+    RCON connections, all driven by a single asyncio event loop.
+    Commands are handed to the connections in chunks of chunk_size. By default each
+    connection waits for a response before sending the next command. With
+    pipeline_depth > 1, up to that many commands are sent before their responses are
+    awaited; this needs a server that accepts pipelined packets (vanilla Minecraft
+    reads one packet per socket read and drops the connection otherwise).
+    Returns the server's response to every command, in order.
+    """
+    print(f"Sending {len(commands)} setblock commands over {pool_size} RCON connections...")
+    results = asyncio.run(_send_commands_async(commands, host, port, password, pool_size, chunk_size,
+                                               pipeline_depth))
     print("Done placing the image in 3D!")
     return results